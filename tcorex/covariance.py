@@ -5,15 +5,109 @@ from scipy.stats import multivariate_normal
 import numpy as np
 
 
-def calculate_nll_score(data, covs):
+def _check_eigvals(s):
+    """ Raise ValueError if the eigenvalues s belong to a singular or not positive definite matrix.
+    The tolerance is the one of scipy.stats.multivariate_normal, so that all ways of computing
+    calculate_nll_score() reject the same matrices.
+    """
+    t = s.dtype.char.lower()
+    eps = {'f': 1e3, 'd': 1e6}[t] * np.finfo(t).eps * np.max(np.abs(s))
+    if np.min(s) <= eps:
+        raise ValueError("the matrix is singular or not positive definite")
+
+
+def _logdet_pd(mat):
+    """ Log-determinant of a positive definite matrix. """
+    s = np.linalg.eigvalsh(mat)
+    _check_eigvals(s)
+    return np.sum(np.log(s))
+
+
+def _logdet_and_inverse_pd(mat):
+    """ Log-determinant and inverse of a positive definite matrix. """
+    s, v = np.linalg.eigh(mat)
+    _check_eigvals(s)
+    return np.sum(np.log(s)), np.dot(v / s, v.T)
+
+
+def second_moments(data):
+    """ Compute x^T x / n for each time period, i.e. the sample_covs argument of calculate_nll_score().
+    :param data: 3d array or list of 2d arrays. A time period can also be a single sample of shape (nv,).
+    """
+    ret = []
+    for x in data:
+        x = np.atleast_2d(x)
+        ret.append(np.dot(x.T, x) / len(x))
+    return ret
+
+
+def calculate_nll_score(data, covs=None, precs=None, sample_covs=None):
     """ Calculate time-averaged negative log-likelihood.
     :param data: 3d array or list of 2d arrays.
     :param covs: list of covariance matrices.
+    :param precs: list of precision matrices. Can be given instead of covs to avoid inverting them.
+    :param sample_covs: list of matrices x^T x / n computed from data (see second_moments()). If given,
+                        the data itself is not used, which is faster when the same data is scored many times.
     """
     nt = len(data)
+    assert (covs is None) != (precs is None)
+    if sample_covs is not None:
+        assert len(sample_covs) == nt
+        return _calculate_nll_score_given_sample_covs(sample_covs, covs=covs, precs=precs)
+    if precs is not None:
+        return _calculate_nll_score_given_precs(data, precs)
     assert len(covs) == nt
     try:
-        nll = [-multivariate_normal.logpdf(data[t], cov=covs[t]).mean() for t in range(nt)]
+        # a covariance matrix shared by several time periods is factorized only once
+        dists = dict()
+        nll = []
+        for t in range(nt):
+            if id(covs[t]) not in dists:
+                dists[id(covs[t])] = multivariate_normal(cov=covs[t])
+            nll.append(-dists[id(covs[t])].logpdf(data[t]).mean())
+    except Exception:
+        nll = [np.inf]
+    return np.mean(nll)
+
+
+def _calculate_nll_score_given_precs(data, precs):
+    """ The same as calculate_nll_score(), but uses precision matrices.
+    -log p(x) = 0.5 * (nv * log(2 pi) - log det(P) + x^T P x).
+    """
+    nt = len(data)
+    assert len(precs) == nt
+    try:
+        logdets = dict()
+        nll = []
+        for t in range(nt):
+            if id(precs[t]) not in logdets:
+                logdets[id(precs[t])] = _logdet_pd(precs[t])
+            x = np.asarray(data[t])
+            quad = np.sum(np.dot(x, precs[t]) * x, axis=-1)
+            nll.append(0.5 * (x.shape[-1] * np.log(2 * np.pi) - logdets[id(precs[t])] + quad).mean())
+    except Exception:
+        nll = [np.inf]
+    return np.mean(nll)
+
+
+def _calculate_nll_score_given_sample_covs(sample_covs, covs=None, precs=None):
+    """ The same as calculate_nll_score(), but uses S = x^T x / n instead of the data.
+    -E[log p(x)] = 0.5 * (nv * log(2 pi) + log det(Sigma) + tr(Sigma^{-1} S)).
+    """
+    mats = (covs if covs is not None else precs)
+    assert len(mats) == len(sample_covs)
+    try:
+        factors = dict()
+        nll = []
+        for t, S in enumerate(sample_covs):
+            nv = S.shape[0]
+            if id(mats[t]) not in factors:
+                if covs is not None:
+                    factors[id(mats[t])] = _logdet_and_inverse_pd(mats[t])
+                else:
+                    factors[id(mats[t])] = (-_logdet_pd(mats[t]), mats[t])
+            logdet, prec = factors[id(mats[t])]
+            nll.append(0.5 * (nv * np.log(2 * np.pi) + logdet + np.sum(prec * S)))
     except Exception:
         nll = [np.inf]
     return np.mean(nll)
@@ -4,30 +4,458 @@ from __future__ import absolute_import
 
 from scipy.io import savemat, loadmat
 from subprocess import Popen, PIPE
-from tcorex.covariance import calculate_nll_score
+from tcorex.covariance import calculate_nll_score, second_moments
 from .data import make_buckets
 
+from collections import OrderedDict
+
 import numpy as np
+import hashlib
+import contextlib
+import copy
 import time
 import itertools
 import random
 import re
 import os
+import uuid
+
+
+def _stackable(train_data):
+    """ Whether train_data is a list of 2D arrays of the same shape, i.e. can be stacked into a 3D array. """
+    shapes = set(np.shape(x) for x in train_data)
+    return len(shapes) == 1 and len(shapes.pop()) == 2
+
+
+# maximal number of data elements stacked into one batch by _map_batched()
+_BATCH_ELEMENTS = 2 ** 22
+
+
+def _map_batched(batched_func, train_data):
+    """ Apply batched_func to stacks of tasks of train_data and return the list of per-task results.
+    The tasks are stacked in chunks of at most _BATCH_ELEMENTS elements (but at least one task),
+    so that only a bounded part of the training data is copied at a time.
+    """
+    ns, nv = train_data[0].shape
+    chunk = max(1, _BATCH_ELEMENTS // (ns * nv))
+    ret = []
+    for start in range(0, len(train_data), chunk):
+        ret.extend(batched_func(np.asarray(train_data[start:start + chunk])))
+    return ret
+
+
+def _batched_empirical_covariance(X):
+    """ Center the tasks of X (nt, ns, nv) and compute their empirical covariance matrices (nt, nv, nv). """
+    X = X - X.mean(axis=1, keepdims=True)
+    return X, np.matmul(X.transpose((0, 2, 1)), X) / X.shape[1]
+
+
+def _shrink(emp_cov, shrinkage, mu):
+    """ (1 - shrinkage) * emp_cov + shrinkage * mu * I for each task. """
+    nv = emp_cov.shape[-1]
+    shrunk_cov = (1.0 - shrinkage)[:, np.newaxis, np.newaxis] * emp_cov
+    shrunk_cov[:, np.arange(nv), np.arange(nv)] += (shrinkage * mu)[:, np.newaxis]
+    return shrunk_cov
+
+
+def _batched_ledoit_wolf(X):
+    """ Ledoit-Wolf estimates for all tasks of X (nt, ns, nv) at once.
+    The computation follows sklearn.covariance.ledoit_wolf.
+    """
+    nt, ns, nv = X.shape
+    X, emp_cov = _batched_empirical_covariance(X)
+    X2 = X ** 2
+    emp_cov_trace = np.sum(X2, axis=1) / ns
+    mu = np.sum(emp_cov_trace, axis=1) / nv
+    beta_ = np.sum(np.sum(X2, axis=2) ** 2, axis=1)  # sum of the coefficients of <X2.T, X2>
+    delta_ = np.sum(emp_cov ** 2, axis=(1, 2))  # sum of the squared coefficients of <X.T, X> / ns^2
+    beta = (beta_ / ns - delta_) / (nv * ns)
+    delta = (delta_ - 2.0 * mu * np.sum(emp_cov_trace, axis=1) + nv * mu ** 2) / nv
+    beta = np.minimum(beta, delta)
+    shrinkage = np.zeros(nt, dtype=emp_cov.dtype)
+    mask = (beta != 0)
+    shrinkage[mask] = beta[mask] / delta[mask]
+    return _shrink(emp_cov, shrinkage, mu)
+
+
+def _batched_oas(X):
+    """ Oracle approximating shrinkage estimates for all tasks of X (nt, ns, nv) at once.
+    The computation follows sklearn.covariance.oas.
+    """
+    nt, ns, nv = X.shape
+    _, emp_cov = _batched_empirical_covariance(X)
+    mu = np.trace(emp_cov, axis1=1, axis2=2) / nv
+    alpha = np.mean(emp_cov ** 2, axis=(1, 2))
+    num = alpha + mu ** 2
+    den = (ns + 1.0) * (alpha - (mu ** 2) / nv)
+    shrinkage = np.ones(nt, dtype=emp_cov.dtype)
+    mask = (den != 0)
+    shrinkage[mask] = np.minimum(num[mask] / den[mask], 1.0)
+    return _shrink(emp_cov, shrinkage, mu)
+
+
+@contextlib.contextmanager
+def _single_thread_blas():
+    """ Limit BLAS to one thread in this block. threadpoolctl needs Python 3.5+; without it
+    the number of threads is not limited.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        yield
+        return
+    with threadpool_limits(limits=1):
+        yield
+
+
+def _solver_env(single_thread):
+    """ Environment of an external solver process. threadpoolctl does not reach subprocesses, so the
+    BLAS/OpenMP threads of solvers that run side by side are limited by environment variables.
+    """
+    if not single_thread:
+        return None
+    env = os.environ.copy()
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        env[var] = '1'
+    return env
+
+
+def _seeded_call(seed, func, args):
+    """ Seed the global random number generators of a worker process, then call func. """
+    random.seed(seed)
+    np.random.seed(seed)
+    return func(*args)
+
+
+def _parallel_map(func, args, n_jobs=1, prefer=None):
+    """ Apply func to each tuple of arguments in args and return the list of results.
+    When n_jobs != 1 the calls are distributed with joblib, while BLAS is limited to one thread
+    per worker to avoid oversubscription. Worker processes do not inherit the state of np.random,
+    so each call is seeded from the random state of the caller. This keeps seeded runs reproducible,
+    but stochastic methods do not give the same results as with n_jobs=1. Threads (prefer='threads')
+    share the global state and are used only for deterministic functions.
+    """
+    if n_jobs == 1:
+        return [func(*a) for a in args]
+    from joblib import Parallel, delayed
+    with _single_thread_blas():
+        if prefer == 'threads':
+            return Parallel(n_jobs=n_jobs, prefer=prefer)(delayed(func)(*a) for a in args)
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(args))
+        return Parallel(n_jobs=n_jobs, prefer=prefer)(delayed(_seeded_call)(int(seed), func, a)
+                                                      for (seed, a) in zip(seeds, args))
+
+
+# Below are single-task fitting functions. They are defined on the module level to be picklable.
+
+
+def _fit_ledoit_wolf(x):
+    import sklearn.covariance as sk_cov
+    est = sk_cov.LedoitWolf()
+    est.fit(x)
+    return est.covariance_
+
+
+def _fit_oas(x):
+    import sklearn.covariance as sk_cov
+    est = sk_cov.OAS()
+    est.fit(x)
+    return est.covariance_
+
+
+def _fit_pca(x, n_components):
+    import sklearn.decomposition as sk_dec
+    est = sk_dec.PCA(n_components=n_components)
+    est.fit(x)
+    return est.get_covariance()
+
+
+def _fit_sparse_pca(x, n_components, alpha, ridge_alpha, max_iter, tol):
+    import sklearn.decomposition as sk_dec
+    est = sk_dec.SparsePCA(n_components=n_components,
+                           alpha=alpha,
+                           ridge_alpha=ridge_alpha,
+                           max_iter=max_iter,
+                           tol=tol)
+    est.fit(x)
+
+    # get covariance: \Psi + \Lambda.T * \Sigma_{zz} * \Lambda
+    z = est.transform(x)
+    z = z - z.mean(axis=0)
+    cov_z = np.dot(z.T, z) / (z.shape[0] - 1)
+    var_x = np.var(x, axis=0)
+    cov = np.dot(est.components_.T, np.dot(cov_z, est.components_))
+    np.fill_diagonal(cov, var_x)
+    return cov
+
+
+def _fit_factor_analysis(x, n_components):
+    import sklearn.decomposition as sk_dec
+    est = sk_dec.FactorAnalysis(n_components=n_components)
+    est.fit(x)
+    return est.get_covariance()
+
+
+def _fit_graph_lasso(emp_cov, alpha, max_iter):
+    import sklearn.covariance as sk_cov
+    cov, _ = sk_cov.graphical_lasso(emp_cov,
+                                    alpha=alpha,
+                                    max_iter=max_iter)
+    return cov
+
+
+def _fit_linear_corex(x, n_hidden, max_iter, anneal, ws=None):
+    """ Fit linear CorEx and return the covariance estimate and the learned weights.
+    If ws is given, the optimization starts from these weights instead of a random initialization
+    (and without annealing). They are shrunk first, since weights that are optimal for another task
+    can be infeasible for x.
+    """
+    import linearcorex
+    c = linearcorex.Corex(n_hidden=n_hidden,
+                          max_iter=max_iter,
+                          anneal=anneal)
+    if ws is not None:
+        c.ws = 0.5 * ws
+    c.fit(x)
+    return c.get_covariance(), c.ws
+
+
+def _invert_all(mats):
+    """ Invert a list of matrices. A matrix repeated in the list is inverted only once. """
+    inverses = dict()
+    for mat in mats:
+        if id(mat) not in inverses:
+            inverses[id(mat)] = np.linalg.inv(mat)
+    return [inverses[id(mat)] for mat in mats]
+
+
+def _data_key(data):
+    """ Content hash of a list of arrays. """
+    h = hashlib.sha1()
+    for x in data:
+        x = np.ascontiguousarray(x)
+        h.update(str((x.shape, x.dtype.str)).encode('utf-8'))
+        h.update(x)
+    return h.hexdigest()
+
+
+_QUIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'methods', 'QUIC')
+_BIGQUIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'methods', 'BigQUIC', 'bigquic')
+
+
+def _compile_quic(verbose):
+    """ Compile the QUIC MEX file, unless it is already newer than the sources. """
+    mex_path = os.path.join(_QUIC_DIR, 'QUIC.mex')
+    sources = [os.path.join(_QUIC_DIR, 'QUIC.C'), os.path.join(_QUIC_DIR, 'QUIC-mex.C')]
+    if os.path.exists(mex_path) and all(os.path.getmtime(mex_path) >= os.path.getmtime(src) for src in sources):
+        return
+    process = Popen(['octave', '--eval', 'mex -llapack QUIC.C QUIC-mex.C;'], cwd=_QUIC_DIR,
+                    stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate()
+    if verbose > 1:
+        print("Stdout:\n{}\nStderr:\n{}".format(stdout, stderr))
+    if process.returncode != 0:
+        raise RuntimeError("Failed to compile QUIC:\n{}".format(stderr))
+
+
+def _run_quic(sample_cov, params, verbose, read_output=True, single_thread=False):
+    """ Run QUIC in Octave on a single sample covariance matrix and return the estimated precision matrix.
+    Every call uses its own files, so several calls can run at the same time; single_thread should then
+    be set to avoid oversubscription. If read_output is False, the solver output is not parsed and None
+    is returned.
+    """
+    exp_id = 'quic_{}'.format(uuid.uuid4().hex)
+    paths = [os.path.join(_QUIC_DIR, exp_id + ext) for ext in ['.m', '.in.mat', '.out.mat']]
+    try:
+        # create exp_id.m file to execute QUIC
+        with open(paths[0], 'w') as f:
+            f.write("load('{}.in.mat');\n".format(exp_id))
+            f.write("[X W opt cputime iter dGap] = QUIC('default', sample_cov, lamb, tol, msg, max_iter);\n")
+            f.write("save('-mat', '{}.out.mat', 'X', 'W', 'opt', 'cputime', 'iter', 'dGap');\n".format(exp_id))
+
+        # create exp_id.in.mat file
+        savemat(paths[1], {
+            'sample_cov': sample_cov,
+            'lamb': float(params['lamb']),
+            'max_iter': params['max_iter'],
+            'tol': params['tol'],
+            'msg': params['msg']
+        })
+
+        # run created exp_id.m file and wait
+        process = Popen(['octave', '{}.m'.format(exp_id)], cwd=_QUIC_DIR, env=_solver_env(single_thread),
+                        stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+        if verbose > 1:
+            print("Stdout:\n{}\nStderr:\n{}".format(stdout, stderr))
+
+        # collect outputs from exp_id.out.mat file
+        if not read_output:
+            return None
+        return loadmat(paths[2])['X']
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _run_bigquic(X, params, verbose, read_output=True, single_thread=False):
+    """ Run BigQUIC on a single data matrix and return the estimated precision matrix.
+    Every call uses its own files, so several calls can run at the same time; single_thread should then
+    be set to avoid oversubscription. If read_output is False, the solver output is not parsed and None
+    is returned.
+    """
+    exp_id = 'bigquic_{}'.format(uuid.uuid4().hex)
+    in_path = os.path.join(_BIGQUIC_DIR, '{}.in.txt'.format(exp_id))
+    out_path = os.path.join(_BIGQUIC_DIR, '{}.out.txt'.format(exp_id))
+    try:
+        _write_bigquic_input(in_path, X)
+        process = Popen(['./bigquic-run',
+                         '-l', str(params['lamb']),
+                         '-t', str(params['max_iter']),
+                         '-q', str(params['verbose']),
+                         '-e', str(params['tol']),
+                         in_path, out_path], cwd=_BIGQUIC_DIR, env=_solver_env(single_thread),
+                        stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+        if verbose > 1:
+            print("Stdout:\n{}\nStderr:\n{}".format(stdout, stderr))
+        if not read_output:
+            return None
+        return _read_bigquic_output(out_path, nv=X.shape[1])
+    finally:
+        for path in [in_path, out_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _write_bigquic_input(path, X):
+    """ Write data in the input format of bigquic-run: a "nv ns" header, then one sample per line. """
+    with open(path, 'w') as f:
+        f.write('{} {}\n'.format(X.shape[1], X.shape[0]))
+        np.savetxt(f, X, fmt='%.9f', delimiter=' ')
+
+
+def _read_bigquic_output(path, nv):
+    """ Read the precision matrix written by bigquic-run as a list of (row, col, value) triples. """
+    precision_mat = np.zeros((nv, nv))
+    with open(path, 'r') as f:
+        ret = re.search('p: ([0-9]+), nnz: ([0-9]+)', f.readline())
+        p = int(ret.group(1))
+        non_zero = int(ret.group(2))
+        assert p == nv
+        if non_zero > 0:
+            entries = np.loadtxt(f, usecols=(0, 1, 2), max_rows=non_zero, ndmin=2)
+            rows = entries[:, 0].astype(np.int64) - 1
+            cols = entries[:, 1].astype(np.int64) - 1
+            precision_mat[rows, cols] = entries[:, 2]
+    return precision_mat
+
+
+def _grid_point(search_params, index):
+    """ Return the index-th element of itertools.product(*search_params) without enumerating the product. """
+    point = []
+    for arr in reversed(search_params):
+        index, i = divmod(index, len(arr))
+        point.append(arr[i])
+    return tuple(reversed(point))
+
+
+def _merge_params(grid_point, const_params):
+    params = dict(grid_point)
+    for k, v in const_params.items():
+        params[k] = v
+    return params
+
+
+def _train_grid_point_safe(baseline, train_data, params, verbose):
+    """ Worker of the parallel grid search. Exceptions are returned instead of being raised, so that
+    a failed grid point does not stop the others. The tasks of a grid point are trained sequentially,
+    as the grid points already occupy the workers.
+    """
+    baseline = copy.copy(baseline)
+    baseline._in_grid_worker = True
+    try:
+        return baseline._train_grid_point(train_data, params, verbose)
+    except Exception as e:
+        return e
+
+
+def _flatten_time_series(data):
+    """ If data is 3D (nt, ns, nv) or a list of (ns, nv) arrays, make it 2D (nt * ns, nv).
+    :return: the 2D array and whether the data was flattened.
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 3:
+        return data.reshape((-1, data.shape[-1])), True
+    if np.ndim(data[0]) == 2:
+        return np.concatenate(data, axis=0), True
+    return np.asarray(data), False
 
 
 class Baseline(object):
-    def __init__(self, name):
+    # whether _train() returns precision matrices instead of covariance matrices
+    _returns_precision = False
+
+    # whether the method is accurate enough to be trained on float32 data (see use_fp32)
+    _supports_fp32 = False
+
+    # set while timeit() runs; _train() can then skip the work that is needed only for its outputs
+    _timing = False
+
+    # set in the copies that train grid points in parallel (see select(..., n_jobs))
+    _in_grid_worker = False
+
+    def __init__(self, name, use_fp32=False, cache_size=0):
+        """
+        :param name: str, name of the method
+        :param use_fp32: boolean, whether to train on float32 data if the method supports it
+        :param cache_size: int, number of _train() outputs kept after select() returns, so that calling
+                           select() again with the same data and an overlapping grid reuses them instead
+                           of training again. By default nothing is kept.
+        """
         self.name = name
+        self.use_fp32 = use_fp32
+        self.cache_size = cache_size
         self._trained = False
         self._val_score = None
         self._params = None
         self._covs = None
+        self._precs = None
         self._method = None
-
-    def select(self, train_data, val_data, params, verbose=True):
+        self._sample_cov_cache = None
+        self._train_cache = OrderedDict()
+
+    def select(self, train_data, val_data, params, verbose=True, n_jobs=1):
+        """ Select the best parameters on a grid using the validation data.
+        :param n_jobs: int, number of grid points to train in parallel. If it is not 1, all grid points
+                       are trained by joblib workers first, and are scored afterwards. The workers train
+                       the tasks of their grid point sequentially, regardless of params['n_jobs'].
+                       Each worker is seeded from np.random, so seeded runs are reproducible, but
+                       stochastic methods give different results than with n_jobs=1.
+        """
         if verbose:
             print("\n{}\nSelecting the best parameter values for {} ...".format('-' * 80, self.name))
 
+        # train_data does not change across the grid, so it is converted to the right dtype and layout
+        # and its sample covariances are computed only once. The tasks are kept in a list to have the
+        # same array objects in every call of _train().
+        train_data = self._normalize_inputs(train_data)
+        # only the sample covariances of these tasks are cached; the arrays are kept alive by train_data,
+        # so their ids are not reused. Buckets are rebuilt at every grid point and are not cached.
+        self._sample_cov_cache = dict((id(x), dict()) for x in train_data)
+        try:
+            return self._select(train_data, val_data, params, verbose, n_jobs)
+        finally:
+            # the ids are valid only while train_data is alive, so the cache must not outlive this call
+            self._sample_cov_cache = None
+
+    def _select(self, train_data, val_data, params, verbose, n_jobs):
+        train_key = _data_key(train_data)
+
+        # the validation data is also the same for all grid points, hence it is enough to compute
+        # x^T x / n once for each time period and score the candidates using these matrices
+        val_sample_covs = second_moments(val_data)
+
         best_score = 1e18
         best_params = None
         best_covs = None
@@ -57,50 +485,74 @@ class Baseline(object):
         if len(search_params) == 0:
             search_params = [[('__dummy__', None)]]
 
-        grid = list(itertools.product(*search_params))
+        # iterate over the grid lazily instead of materializing all combinations
+        grid_size = int(np.prod([len(arr) for arr in search_params]))
         if random_iters is not None:
-            random.shuffle(grid)
-            grid = grid[:random_iters]
-
+            sampled = random.sample(range(grid_size), min(random_iters, grid_size))
+            grid = (_grid_point(search_params, i) for i in sampled)
+            grid_size = len(sampled)
+        else:
+            grid = itertools.product(*search_params)
+
+        prefetched = None
+        if n_jobs != 1:
+            # one-time setup is done here, so that the workers do not repeat it concurrently
+            self._prepare(verbose)
+            grid = list(grid)
+            todo = OrderedDict()
+            for cur_params in grid:
+                cur_params = _merge_params(cur_params, const_params)
+                key = self._train_cache_key(train_key, cur_params)
+                if key not in self._train_cache:
+                    todo[key] = cur_params
+            todo = list(todo.items())
+            outputs = _parallel_map(_train_grid_point_safe,
+                                    [(self, train_data, cur_params, verbose) for (_, cur_params) in todo],
+                                    n_jobs=n_jobs)
+            prefetched = dict(zip([key for (key, _) in todo], outputs))
+
+        # scores of the grid points trained so far; a duplicate grid point gets the score of the first one
+        # and is not trained again. It cannot be better than the first one, so its outputs are not needed.
+        scores = dict()
         for index, cur_params in enumerate(grid):
             if verbose:
-                print("done {} / {}".format(index, len(grid)), end='')
+                print("done {} / {}".format(index, grid_size), end='')
                 print(" | running with ", end='')
                 for k, v in cur_params:
                     if k != '__dummy__':
                         print('{}: {}\t'.format(k, v), end='')
                 print('')
 
-            cur_params = dict(cur_params)
-            for k, v in const_params.items():
-                cur_params[k] = v
+            cur_params = _merge_params(cur_params, const_params)
+            key = self._train_cache_key(train_key, cur_params)
+            if key in scores:
+                results.append((cur_params, scores[key]))
+                if verbose:
+                    print('\tduplicate grid point, current score: {}'.format(scores[key]))
+                continue
 
-            # divide into buckets if needed
             try:
-                if 'window' in cur_params:
-                    assert 'stride' in cur_params
-                    cur_window = cur_params.pop('window')
-                    cur_stride = cur_params.pop('stride')
-                    bucketed_train_data, index_to_bucket = make_buckets(train_data, cur_window, cur_stride)
-                    (cur_covs, cur_method) = self._train(bucketed_train_data, cur_params, verbose)
-                    if cur_covs is not None:
-                        cur_covs = [cur_covs[index_to_bucket[i]] for i in range(len(train_data))]
-                    cur_params['window'] = cur_window
-                    cur_params['stride'] = cur_stride
+                (cur_covs, cur_method) = self._cached_train(train_data, key, cur_params, verbose,
+                                                            prefetched=prefetched)
+                if self._returns_precision:
+                    # cur_covs are precision matrices, they are inverted only for the best parameters
+                    cur_score = calculate_nll_score(data=val_data, precs=cur_covs, sample_covs=val_sample_covs)
                 else:
-                    (cur_covs, cur_method) = self._train(train_data, cur_params, verbose)
-                cur_score = calculate_nll_score(data=val_data, covs=cur_covs)
+                    cur_score = calculate_nll_score(data=val_data, covs=cur_covs, sample_covs=val_sample_covs)
             except Exception as e:
                 print("Failed to train and evaluate method: {}, message: {}".format(self.name, str(e)))
                 cur_score = None
                 cur_covs = None
                 cur_method = None
             results.append((cur_params, cur_score))
+            scores[key] = cur_score
 
             if verbose:
                 print('\tcurrent score: {}'.format(cur_score))
 
-            if (best_params is None) or (not np.isnan(cur_score) and cur_score < best_score):
+            # failed grid points (cur_score is None) are reported in results, but never selected
+            if cur_score is not None and ((best_params is None) or
+                                          (not np.isnan(cur_score) and cur_score < best_score)):
                 best_score = cur_score
                 best_params = cur_params
                 best_covs = cur_covs
@@ -108,6 +560,11 @@ class Baseline(object):
         if verbose:
             print('\nFinished with best validation score: {}'.format(best_score))
 
+        self._precs = None
+        if self._returns_precision and best_covs is not None:
+            self._precs = best_covs
+            best_covs = _invert_all(best_covs)
+
         self._trained = True
         self._val_score = best_score
         self._params = best_params
@@ -116,15 +573,109 @@ class Baseline(object):
 
         return best_score, best_params, best_covs, best_method, results
 
+    def _normalize_inputs(self, train_data):
+        """ Convert each task to a C-contiguous floating point array, so that the estimators do not
+        copy the data in each fit. float32 is used if use_fp32 is set and the method supports it.
+        """
+        ret = []
+        for x in train_data:
+            x = np.asarray(x)
+            if self.use_fp32 and self._supports_fp32:
+                dtype = np.float32
+            elif np.issubdtype(x.dtype, np.floating):
+                dtype = x.dtype
+            else:
+                dtype = np.float64
+            ret.append(np.ascontiguousarray(x, dtype=dtype))
+        return ret
+
+    @staticmethod
+    def _train_cache_key(data_key, params):
+        return data_key, repr(sorted(params.items()))
+
+    def _cached_train(self, train_data, key, params, verbose, prefetched=None):
+        """ Train with the given parameters, reusing the outputs of a previous select() call with the same
+        data and parameters if they are still in the cache (only if cache_size > 0). Outputs computed by
+        parallel workers are taken from prefetched.
+        """
+        if key in self._train_cache:
+            ret = self._train_cache.pop(key)
+        elif prefetched is not None and key in prefetched:
+            ret = prefetched.pop(key)
+            if isinstance(ret, Exception):
+                raise ret
+        else:
+            ret = self._train_grid_point(train_data, params, verbose)
+        if self.cache_size > 0:
+            self._train_cache[key] = ret
+            while len(self._train_cache) > self.cache_size:
+                self._train_cache.popitem(last=False)
+        return ret
+
+    def _train_grid_point(self, train_data, params, verbose):
+        # divide into buckets if needed
+        if 'window' in params:
+            assert 'stride' in params
+            cur_window = params.pop('window')
+            cur_stride = params.pop('stride')
+            bucketed_train_data, index_to_bucket = make_buckets(train_data, cur_window, cur_stride)
+            (covs, method) = self._train(bucketed_train_data, params, verbose)
+            if covs is not None:
+                covs = [covs[index_to_bucket[i]] for i in range(len(train_data))]
+            params['window'] = cur_window
+            params['stride'] = cur_stride
+        else:
+            (covs, method) = self._train(train_data, params, verbose)
+        return covs, method
+
+    def __getstate__(self):
+        # the caches are not sent to the workers of the parallel grid search. The sample covariance
+        # cache is keyed by ids of arrays of this process, so it is disabled in the workers.
+        state = self.__dict__.copy()
+        state['_train_cache'] = OrderedDict()
+        state['_sample_cov_cache'] = None
+        return state
+
+    def _prepare(self, verbose):
+        """ One-time setup needed by _train(), e.g. building external solvers. """
+        pass
+
+    def _task_n_jobs(self, params):
+        """ Number of tasks that _train() fits in parallel: params['n_jobs'] (1 by default),
+        or 1 inside a worker of the parallel grid search.
+        """
+        if self._in_grid_worker:
+            return 1
+        return params.get('n_jobs', 1)
+
     def _train(self, train_data, params, verbose):
         # should return a pair: (covs, method)
+        # covs should be precision matrices if _returns_precision is True
         raise NotImplementedError()
 
+    def _sample_cov(self, x, assume_centered=False):
+        """ Compute the sample covariance of x. During select() the results are cached for the tasks
+        of the training data.
+        """
+        cache = None
+        if self._sample_cov_cache is not None:
+            cache = self._sample_cov_cache.get(id(x))
+        if cache is not None and assume_centered in cache:
+            return cache[assume_centered]
+        xc = x if assume_centered else x - x.mean(axis=0)
+        cov = np.dot(xc.T, xc) / x.shape[0]
+        if cache is not None:
+            cache[assume_centered] = cov
+        return cov
+
     def evaluate(self, test_data, verbose=True):
         assert self._trained
         if verbose:
             print("Evaluating {} ...".format(self.name))
-        nll = calculate_nll_score(data=test_data, covs=self._covs)
+        if self._precs is not None:
+            nll = calculate_nll_score(data=test_data, precs=self._precs)
+        else:
+            nll = calculate_nll_score(data=test_data, covs=self._covs)
         if verbose:
             print("\tScore: {:.4f}".format(nll))
         return nll
@@ -134,9 +685,18 @@ class Baseline(object):
         return self._covs
 
     def timeit(self, train_data, params):
-        start_time = time.time()
-        _ = self._train(train_data, params, verbose=False)
-        finish_time = time.time()
+        """ Measure the training time. The same _train() as in select() is run, but the methods
+        may skip reading or post-processing their outputs, which are not returned.
+        One-time setup (_prepare(), e.g. compiling QUIC) is not timed.
+        """
+        self._prepare(False)
+        self._timing = True
+        try:
+            start_time = time.time()
+            _ = self._train(train_data, params, verbose=False)
+            finish_time = time.time()
+        finally:
+            self._timing = False
         return finish_time - start_time
 
 
@@ -152,6 +712,8 @@ class GroundTruth(Baseline):
 
 
 class Diagonal(Baseline):
+    _supports_fp32 = True
+
     def __init__(self, min_var=1e-6, **kwargs):
         super(Diagonal, self).__init__(**kwargs)
         self.min_var = min_var
@@ -168,19 +730,20 @@ class Diagonal(Baseline):
 
 
 class LedoitWolf(Baseline):
+    _supports_fp32 = True
+
     def __init__(self, **kwargs):
         super(LedoitWolf, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.covariance as sk_cov
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
-        covs = []
-        for x in train_data:
-            est = sk_cov.LedoitWolf()
-            est.fit(x)
-            covs.append(est.covariance_)
+        if _stackable(train_data):
+            covs = _map_batched(_batched_ledoit_wolf, train_data)
+        else:
+            covs = _parallel_map(_fit_ledoit_wolf, [(x,) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params), prefer='threads')
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
@@ -188,19 +751,20 @@ class LedoitWolf(Baseline):
 
 
 class OAS(Baseline):
+    _supports_fp32 = True
+
     def __init__(self, **kwargs):
         super(OAS, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.covariance as sk_cov
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
-        covs = []
-        for x in train_data:
-            est = sk_cov.OAS()
-            est.fit(x)
-            covs.append(est.covariance_)
+        if _stackable(train_data):
+            covs = _map_batched(_batched_oas, train_data)
+        else:
+            covs = _parallel_map(_fit_oas, [(x,) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params), prefer='threads')
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
@@ -208,20 +772,18 @@ class OAS(Baseline):
 
 
 class PCA(Baseline):
+    _supports_fp32 = True
+
     def __init__(self, **kwargs):
         super(PCA, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.decomposition as sk_dec
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
         try:
-            covs = []
-            for x in train_data:
-                est = sk_dec.PCA(n_components=params['n_components'])
-                est.fit(x)
-                covs.append(est.get_covariance())
+            covs = _parallel_map(_fit_pca, [(x, params['n_components']) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params))
         except Exception as e:
             covs = None
             if verbose:
@@ -237,28 +799,14 @@ class SparsePCA(Baseline):
         super(SparsePCA, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.decomposition as sk_dec
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
         try:
-            covs = []
-            for x in train_data:
-                est = sk_dec.SparsePCA(n_components=params['n_components'],
-                                       alpha=params['alpha'],
-                                       ridge_alpha=params['ridge_alpha'],
-                                       max_iter=params['max_iter'],
-                                       tol=params['tol'])
-                est.fit(x)
-
-                # get covariance: \Psi + \Lambda.T * \Sigma_{zz} * \Lambda
-                z = est.transform(x)
-                cov_z = np.cov(z.T)
-                var_x = np.var(x, axis=0)
-                cov = np.dot(est.components_.T, np.dot(cov_z, est.components_))
-                np.fill_diagonal(cov, var_x)
-
-                covs.append(cov)
+            covs = _parallel_map(_fit_sparse_pca,
+                                 [(x, params['n_components'], params['alpha'], params['ridge_alpha'],
+                                   params['max_iter'], params['tol']) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params))
         except Exception as e:
             covs = None
             if verbose:
@@ -270,20 +818,18 @@ class SparsePCA(Baseline):
 
 
 class FactorAnalysis(Baseline):
+    _supports_fp32 = True
+
     def __init__(self, **kwargs):
         super(FactorAnalysis, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.decomposition as sk_dec
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
         try:
-            covs = []
-            for x in train_data:
-                est = sk_dec.FactorAnalysis(n_components=params['n_components'])
-                est.fit(x)
-                covs.append(est.get_covariance())
+            covs = _parallel_map(_fit_factor_analysis, [(x, params['n_components']) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params))
         except Exception as e:
             covs = None
             if verbose:
@@ -299,17 +845,13 @@ class GraphLasso(Baseline):
         super(GraphLasso, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import sklearn.covariance as sk_cov
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
         try:
-            covs = []
-            for x in train_data:
-                est = sk_cov.GraphLasso(alpha=params['alpha'],
-                                        max_iter=params['max_iter'])
-                est.fit(x)
-                covs.append(est.covariance_)
+            covs = _parallel_map(_fit_graph_lasso,
+                                 [(self._sample_cov(x), params['alpha'], params['max_iter']) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params))
         except Exception as e:
             if verbose:
                 print("\t{} failed with message: {}".format(self.name, e.message))
@@ -325,17 +867,21 @@ class LinearCorex(Baseline):
         super(LinearCorex, self).__init__(**kwargs)
 
     def _train(self, train_data, params, verbose):
-        import linearcorex
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
-        covs = []
-        for x in train_data:
-            c = linearcorex.Corex(n_hidden=params['n_hidden'],
-                                  max_iter=params['max_iter'],
-                                  anneal=params['anneal'])
-            c.fit(x)
-            covs.append(c.get_covariance())
+        if params.get('warm_start', False):
+            # each task starts from the weights learned on the previous one, so the tasks are trained sequentially
+            covs = []
+            ws = None
+            for x in train_data:
+                cov, ws = _fit_linear_corex(x, params['n_hidden'], params['max_iter'], params['anneal'], ws=ws)
+                covs.append(cov)
+        else:
+            outs = _parallel_map(_fit_linear_corex,
+                                 [(x, params['n_hidden'], params['max_iter'], params['anneal']) for x in train_data],
+                                 n_jobs=self._task_n_jobs(params))
+            covs = [cov for (cov, _) in outs]
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
@@ -343,6 +889,8 @@ class LinearCorex(Baseline):
 
 
 class TimeVaryingGraphLasso(Baseline):
+    _returns_precision = True
+
     def __init__(self, **kwargs):
         super(TimeVaryingGraphLasso, self).__init__(**kwargs)
 
@@ -352,12 +900,7 @@ class TimeVaryingGraphLasso(Baseline):
             print("Training {} ...".format(self.name))
         start_time = time.time()
 
-        # if data is 3D (nt, ns, nv), make it 2D (nt * ns, nv)
-        train_data = np.array(train_data)
-        flattened = False
-        if train_data.ndim == 3:
-            train_data = train_data.reshape((-1, train_data.shape[-1]))
-            flattened = True
+        train_data, flattened = _flatten_time_series(train_data)
 
         inv_bucket_covs = TVGL.TVGL(data=train_data,
                                     lengthOfSlice=params['lengthOfSlice'],
@@ -365,36 +908,16 @@ class TimeVaryingGraphLasso(Baseline):
                                     beta=params['beta'],
                                     indexOfPenalty=params['indexOfPenalty'],
                                     max_iter=params['max_iter'])
-        bucket_covs = [np.linalg.inv(x) for x in inv_bucket_covs]
-        covs = []
+        inv_covs = []
         if flattened:
-            covs = bucket_covs
+            inv_covs = inv_bucket_covs
         else:
             for i in range(len(train_data)):
-                covs.append(bucket_covs[i // params['lengthOfSlice']])
+                inv_covs.append(inv_bucket_covs[i // params['lengthOfSlice']])
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
-        return covs, None
-
-    def timeit(self, train_data, params):
-        # need to write special timeit() to exclude the time spent for linalg.inv()
-        from tcorex.experiments.methods.TVGL import TVGL
-        start_time = time.time()
-
-        # if data is 3D (nt, ns, nv), make it 2D (nt * ns, nv)
-        train_data = np.array(train_data)
-        if train_data.ndim == 3:
-            train_data = train_data.reshape((-1, train_data.shape[-1]))
-
-        _ = TVGL.TVGL(data=np.array(train_data),
-                      lengthOfSlice=params['lengthOfSlice'],
-                      lamb=params['lamb'],
-                      beta=params['beta'],
-                      indexOfPenalty=params['indexOfPenalty'],
-                      max_iter=params['max_iter'])
-        finish_time = time.time()
-        return finish_time - start_time
+        return inv_covs, None
 
 
 class TCorex(Baseline):
@@ -410,110 +933,49 @@ class TCorex(Baseline):
         params['nt'] = len(train_data)
         c = self.tcorex(**params)
         c.fit(train_data)
-        covs = c.get_covariance()
+        covs = (None if self._timing else c.get_covariance())
 
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
         return covs, c
 
-    def timeit(self, train_data, params):
-        start_time = time.time()
-        params['nt'] = len(train_data)
-        c = self.tcorex(**params)
-        c.fit(train_data)
-        finish_time = time.time()
-        return finish_time - start_time
-
 
 class QUIC(Baseline):
+    _returns_precision = True
+
     def __init__(self, **kwargs):
         super(QUIC, self).__init__(**kwargs)
 
+    def _prepare(self, verbose):
+        _compile_quic(verbose)
+
     def _train(self, train_data, params, verbose):
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
-        os.chdir('tcorex/experiments/methods/QUIC')
 
-        # create exp_id.m file to execute QUIC
-        exp_id = random.randint(0, 2 ** 64)
-        with open('{}.m'.format(exp_id), 'w') as f:
-            f.write("mex -llapack QUIC.C QUIC-mex.C;\n")
-            f.write("load('{}.in.mat');\n".format(exp_id))
-            f.write("[X W opt cputime iter dGap] = QUIC('default', sample_cov, lamb, tol, msg, max_iter);\n")
-            f.write("save('-mat', '{}.out.mat', 'X', 'W', 'opt', 'cputime', 'iter', 'dGap');\n".format(exp_id))
-
-        covs = []
-        for X in train_data:
-            # create exp_id.in.mat file
-            savemat('{}.in.mat'.format(exp_id), {
-                'sample_cov': np.dot(X.T, X) / X.shape[0],
-                'lamb': np.float(params['lamb']),
-                'max_iter': params['max_iter'],
-                'tol': params['tol'],
-                'msg': params['msg']
-            })
-
-            # run created exp_id.m file and wait
-            process = Popen(['octave', '{}.m'.format(exp_id)], stdout=PIPE, stderr=PIPE)
-            process.wait()
-            if verbose > 1:
-                stdout, stderr = process.communicate()
-                print("Stdout:\n{}\nStderr:\n{}".format(stdout, stderr))
-
-            # collect outputs from exp_id.out.mat file
-            outs = loadmat('{}.out.mat'.format(exp_id))
-            covs.append(np.linalg.inv(outs['X']))
-
-        # delete files and come back to the root directory
-        os.remove('{}.in.mat'.format(exp_id))
-        os.remove('{}.out.mat'.format(exp_id))
-        os.remove('{}.m'.format(exp_id))
-        os.chdir('../../../../')
+        # compile QUIC (if needed) before the parallel runs below, so they do not compete for writing the MEX file.
+        # In the parallel grid search this was already done by select() and is a no-op here.
+        self._prepare(verbose)
+        # QUIC is given uncentered sample covariances, which are cached across the grid points during select()
+        sample_covs = [self._sample_cov(X, assume_centered=True) for X in train_data]
+        n_jobs = self._task_n_jobs(params)
+        single_thread = (n_jobs != 1 or self._in_grid_worker)
+        inv_covs = _parallel_map(_run_quic,
+                                 [(sample_cov, params, verbose, not self._timing, single_thread)
+                                  for sample_cov in sample_covs],
+                                 n_jobs=n_jobs, prefer='threads')
 
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
-        return covs, None
-
-    def timeit(self, train_data, params):
-        start_time = time.time()
-        os.chdir('tcorex/experiments/methods/QUIC')
-
-        # create exp_id.m file to execute QUIC
-        exp_id = random.randint(0, 2 ** 64)
-        with open('{}.m'.format(exp_id), 'w') as f:
-            f.write("mex -llapack QUIC.C QUIC-mex.C;\n")
-            f.write("load('{}.in.mat');\n".format(exp_id))
-            f.write("[X W opt cputime iter dGap] = QUIC('default', sample_cov, lamb, tol, msg, max_iter);\n")
-            f.write("save('-mat', '{}.out.mat', 'X', 'W', 'opt', 'cputime', 'iter', 'dGap');\n".format(exp_id))
-
-        for X in train_data:
-            # create exp_id.in.mat file
-            savemat('{}.in.mat'.format(exp_id), {
-                'sample_cov': np.dot(X.T, X) / X.shape[0],
-                'lamb': np.float(params['lamb']),
-                'max_iter': params['max_iter'],
-                'tol': params['tol'],
-                'msg': params['msg']
-            })
-
-            # run created exp_id.m file and wait
-            process = Popen(['octave', '{}.m'.format(exp_id)], stdout=PIPE, stderr=PIPE)
-            process.wait()
-
-        # delete files and come back to the root directory
-        os.remove('{}.in.mat'.format(exp_id))
-        os.remove('{}.out.mat'.format(exp_id))
-        os.remove('{}.m'.format(exp_id))
-        os.chdir('../../../..')
-
-        finish_time = time.time()
-        return finish_time - start_time
+        return inv_covs, None
 
 
 class BigQUIC(Baseline):
+    _returns_precision = True
+
     def __init__(self, **kwargs):
         super(BigQUIC, self).__init__(**kwargs)
 
@@ -521,97 +983,15 @@ class BigQUIC(Baseline):
         if verbose:
             print("Training {} ...".format(self.name))
         start_time = time.time()
-        os.chdir('tcorex/experiments/methods/BigQUIC/bigquic')
-
-        exp_id = random.randint(0, 2 ** 64)
-        covs = []
-        for X in train_data:
-            # create exp_id.in.txt file
-            with open('{}.in.txt'.format(exp_id), 'w') as f:
-                f.write('{} {}\n'.format(X.shape[1], X.shape[0]))
-                for x in X:
-                    f.write(' '.join(['{:.9f}'.format(t) for t in x]) + '\n')
-
-            # build exp_id.sh file
-            with open('{}.sh'.format(exp_id), 'w') as f:
-                f.write('./bigquic-run -l {} -t {} -q {} -e {} {}.in.txt {}.out.txt;\n'.format(
-                    params['lamb'],
-                    params['max_iter'],
-                    params['verbose'],
-                    params['tol'],
-                    exp_id,
-                    exp_id
-                ))
-
-            # run created exp_id.m file and wait
-            process = Popen(['bash', '{}.sh'.format(exp_id)], stdout=PIPE, stderr=PIPE)
-            process.wait()
-            if verbose > 1:
-                stdout, stderr = process.communicate()
-                print("Stdout:\n{}\nStderr:\n{}".format(stdout, stderr))
-
-            # collect outputs from exp_id.out.txt file
-            nv = X.shape[1]
-            precision_mat = np.zeros((nv, nv))
-            with open('{}.out.txt'.format(exp_id), 'r') as f:
-                ret = re.search('p: ([0-9]+), nnz: ([0-9]+)', f.readline())
-                p = int(ret.group(1))
-                non_zero = int(ret.group(2))
-                assert p == nv
-                for i in range(non_zero):
-                    mas = f.readline().split(' ')
-                    row, col = map(int, mas[:2])
-                    value = float(mas[2])
-                    precision_mat[row - 1, col - 1] = value
-
-            covs.append(np.linalg.inv(precision_mat))
-
-        # delete files and come back to the root directory
-        os.remove('{}.in.txt'.format(exp_id))
-        os.remove('{}.out.txt'.format(exp_id))
-        os.remove('{}.sh'.format(exp_id))
-        os.chdir('../../../../../')
-
+        n_jobs = self._task_n_jobs(params)
+        single_thread = (n_jobs != 1 or self._in_grid_worker)
+        inv_covs = _parallel_map(_run_bigquic,
+                                 [(X, params, verbose, not self._timing, single_thread) for X in train_data],
+                                 n_jobs=n_jobs, prefer='threads')
         finish_time = time.time()
         if verbose:
             print("\tElapsed time {:.1f}s".format(finish_time - start_time))
-        return covs, None
-
-    def timeit(self, train_data, params):
-        start_time = time.time()
-        os.chdir('tcorex/experiments/methods/BigQUIC/bigquic')
-
-        exp_id = random.randint(0, 2 ** 64)
-        for X in train_data:
-            # create exp_id.in.txt file
-            with open('{}.in.txt'.format(exp_id), 'w') as f:
-                f.write('{} {}\n'.format(X.shape[1], X.shape[0]))
-                for x in X:
-                    f.write(' '.join(['{:.9f}'.format(t) for t in x]) + '\n')
-
-            # build exp_id.sh file
-            with open('{}.sh'.format(exp_id), 'w') as f:
-                f.write('./bigquic-run -l {} -t {} -q {} -e {} {}.in.txt {}.out.txt;\n'.format(
-                    params['lamb'],
-                    params['max_iter'],
-                    params['verbose'],
-                    params['tol'],
-                    exp_id,
-                    exp_id
-                ))
-
-            # run created exp_id.m file and wait
-            process = Popen(['bash', '{}.sh'.format(exp_id)], stdout=PIPE, stderr=PIPE)
-            process.wait()
-
-        # delete files and come back to the root directory
-        os.remove('{}.in.txt'.format(exp_id))
-        os.remove('{}.out.txt'.format(exp_id))
-        os.remove('{}.sh'.format(exp_id))
-        os.chdir('../../../../../')
-
-        finish_time = time.time()
-        return finish_time - start_time
+        return inv_covs, None
 
 
 class LTGL(Baseline):
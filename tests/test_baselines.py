@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from tcorex.experiments import baselines
+import sklearn.covariance as sk_cov
+import numpy as np
+import itertools
+import tempfile
+import shutil
+import os
+
+
+def test_batched_shrinkage_estimators():
+    r""" Batched Ledoit-Wolf and OAS estimates should match the ones of sklearn, task by task.
+    """
+    for nv in [1, 2, 10]:
+        for dtype in [np.float64, np.float32]:
+            X = np.random.RandomState(nv).normal(size=(3, 20, nv)).astype(dtype)
+            rtol = (1e-10 if dtype == np.float64 else 1e-4)
+            for batched, estimator in [(baselines._batched_ledoit_wolf, sk_cov.LedoitWolf),
+                                       (baselines._batched_oas, sk_cov.OAS)]:
+                covs = batched(X)
+                assert covs.shape == (3, nv, nv)
+                assert np.all(np.isfinite(covs))
+                for x, cov in zip(X, covs):
+                    expected = estimator().fit(x).covariance_
+                    assert np.allclose(cov, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
+
+
+def test_batched_shrinkage_in_chunks():
+    r""" Stacking the tasks in several chunks should give the same estimates as one stack.
+    """
+    X = np.random.RandomState(0).normal(size=(5, 20, 4))
+    old_batch_elements = baselines._BATCH_ELEMENTS
+    baselines._BATCH_ELEMENTS = 2 * 20 * 4
+    try:
+        for batched in [baselines._batched_ledoit_wolf, baselines._batched_oas]:
+            covs = baselines._map_batched(batched, list(X))
+            assert len(covs) == 5
+            assert np.allclose(np.array(covs), batched(X))
+    finally:
+        baselines._BATCH_ELEMENTS = old_batch_elements
+
+
+def test_read_bigquic_output():
+    r""" The sparse (row, col, value) output of bigquic-run should be read into a dense matrix.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'out.txt')
+        with open(path, 'w') as f:
+            f.write('p: 3, nnz: 4\n1 1 2.5\n2 3 -0.5\n3 2 -0.5\n3 3 1.0\n')
+        expected = np.array([[2.5, 0.0, 0.0],
+                             [0.0, 0.0, -0.5],
+                             [0.0, -0.5, 1.0]])
+        assert np.array_equal(baselines._read_bigquic_output(path, nv=3), expected)
+
+        with open(path, 'w') as f:
+            f.write('p: 2, nnz: 0\n')
+        assert np.array_equal(baselines._read_bigquic_output(path, nv=2), np.zeros((2, 2)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_grid_point():
+    r""" _grid_point(search_params, i) should be the i-th element of itertools.product(*search_params).
+    """
+    search_params = [[('a', 1), ('a', 2)], [('b', 'x')], [('c', 0.1), ('c', 0.2), ('c', 0.3)]]
+    grid = list(itertools.product(*search_params))
+    for i, point in enumerate(grid):
+        assert baselines._grid_point(search_params, i) == point
+
+
+def test_select_random_iters():
+    r""" With _random_iters, select() should try that many distinct points of the grid.
+    """
+    data = [np.random.RandomState(0).normal(size=(20, 3)) for _ in range(2)]
+    method = baselines.Diagonal(name='Diagonal')
+    results = method.select(data, data, {'a': [1, 2, 3], 'b': [4, 5], '_random_iters': 4}, verbose=False)[-1]
+    points = set((p['a'], p['b']) for (p, _) in results)
+    assert len(results) == 4
+    assert len(points) == 4
+    assert points <= set(itertools.product([1, 2, 3], [4, 5]))
+
+
+class _CountingGraphLasso(baselines.GraphLasso):
+    """ GraphLasso that counts its _train() calls and fails for alpha < 0. """
+    n_calls = 0
+
+    def _train(self, train_data, params, verbose):
+        _CountingGraphLasso.n_calls += 1
+        if params['alpha'] < 0:
+            raise ValueError("negative alpha")
+        return super(_CountingGraphLasso, self)._train(train_data, params, verbose)
+
+
+def _select_data():
+    rng = np.random.RandomState(0)
+    return [rng.normal(size=(30, 4)) for _ in range(3)], [rng.normal(size=(30, 4)) for _ in range(3)]
+
+
+def test_select_parallel_matches_sequential():
+    r""" On a deterministic method, the parallel grid search should give the same results as the sequential one.
+    A failing grid point should be reported with score None and should not be selected.
+    """
+    train_data, val_data = _select_data()
+    params = {'alpha': [0.1, -1.0, 0.3, 0.1], 'max_iter': 100}
+    outs = []
+    for n_jobs in [1, 2]:
+        method = _CountingGraphLasso(name='GraphLasso')
+        outs.append(method.select(train_data, val_data, dict(params), verbose=False, n_jobs=n_jobs))
+    for out in outs:
+        scores = [score for (_, score) in out[-1]]
+        assert scores[1] is None
+        assert scores[0] == scores[3]
+        assert out[0] == min(scores[0], scores[2])
+    assert outs[0][0] == outs[1][0]
+    assert outs[0][1] == outs[1][1]
+    assert [score for (_, score) in outs[0][-1]] == [score for (_, score) in outs[1][-1]]
+
+
+def test_select_trains_each_point_once():
+    r""" Duplicate grid points should be trained once. With cache_size > 0, a second select() call with
+    the same data should reuse the outputs of the first one.
+    """
+    train_data, val_data = _select_data()
+    params = {'alpha': [0.1, 0.1, 0.3], 'max_iter': 100}
+
+    _CountingGraphLasso.n_calls = 0
+    method = _CountingGraphLasso(name='GraphLasso')
+    method.select(train_data, val_data, dict(params), verbose=False)
+    assert _CountingGraphLasso.n_calls == 2
+    method.select(train_data, val_data, dict(params), verbose=False)
+    assert _CountingGraphLasso.n_calls == 4
+
+    _CountingGraphLasso.n_calls = 0
+    method = _CountingGraphLasso(name='GraphLasso', cache_size=2)
+    first = method.select(train_data, val_data, dict(params), verbose=False)
+    second = method.select(train_data, val_data, dict(params), verbose=False)
+    assert _CountingGraphLasso.n_calls == 2
+    assert first[0] == second[0]
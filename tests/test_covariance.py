@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from tcorex.covariance import calculate_nll_score, second_moments
+import numpy as np
+
+
+def _random_covs(nt, nv, seed=0):
+    rng = np.random.RandomState(seed)
+    covs = []
+    for _ in range(nt):
+        A = rng.normal(size=(nv, nv))
+        covs.append(np.dot(A, A.T) / nv + np.eye(nv))
+    return covs
+
+
+def _check_nll_paths(data, covs):
+    expected = calculate_nll_score(data=data, covs=covs)
+    precs = [np.linalg.inv(cov) for cov in covs]
+    sample_covs = second_moments(data)
+    assert np.isfinite(expected)
+    assert np.allclose(calculate_nll_score(data=data, precs=precs), expected)
+    assert np.allclose(calculate_nll_score(data=data, covs=covs, sample_covs=sample_covs), expected)
+    assert np.allclose(calculate_nll_score(data=data, precs=precs, sample_covs=sample_covs), expected)
+
+
+def test_nll_score_3d_data():
+    r""" The precs and sample_covs paths of calculate_nll_score should agree with the logpdf path.
+    """
+    nt, ns, nv = 4, 20, 6
+    data = np.random.RandomState(1).normal(size=(nt, ns, nv))
+    _check_nll_paths(data, _random_covs(nt, nv))
+
+
+def test_nll_score_2d_data():
+    r""" The same check when every time period has a single sample, i.e. data has shape (nt, nv).
+    """
+    nt, nv = 10, 6
+    data = np.random.RandomState(2).normal(size=(nt, nv))
+    _check_nll_paths(data, _random_covs(nt, nv))
+
+
+def test_nll_score_ill_conditioned():
+    r""" All paths of calculate_nll_score should reject the same (numerically) singular matrices.
+    """
+    data = np.random.RandomState(3).normal(size=(2, 20, 3))
+    sample_covs = second_moments(data)
+    singular = [np.diag([1e4, 1.0, 1e-7])] * 2
+    assert calculate_nll_score(data=data, covs=singular) == np.inf
+    assert calculate_nll_score(data=data, covs=singular, sample_covs=sample_covs) == np.inf
+    precs = [np.linalg.inv(cov) for cov in singular]
+    assert calculate_nll_score(data=data, precs=precs) == np.inf
+    assert calculate_nll_score(data=data, precs=precs, sample_covs=sample_covs) == np.inf
+
+    # a badly scaled, but not singular, matrix is accepted by all paths
+    _check_nll_paths(data, [np.diag([1e4, 1.0, 1e-5])] * 2)